@@ -0,0 +1,23 @@
+-- Add unique index on medication_logs schedule slots
+-- Lets the scheduler bulk-upsert daily logs and skip rows that already exist
+-- Requirements: 15.1
+
+-- Remove duplicate logs for the same slot, keeping the most informative one:
+-- a taken/skipped record first, then missed, then the earliest created
+DELETE FROM medication_logs
+  WHERE id IN (
+    SELECT id FROM (
+      SELECT id, row_number() OVER (
+        PARTITION BY medication_id, patient_id, scheduled_time
+        ORDER BY (status IN ('taken', 'skipped')) DESC, (status = 'missed') DESC, created_at, id
+      ) AS rn
+      FROM medication_logs
+    ) ranked
+    WHERE rn > 1
+  );
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_medication_logs_unique_schedule
+  ON medication_logs(medication_id, patient_id, scheduled_time);
+
+COMMENT ON INDEX idx_medication_logs_unique_schedule IS
+  'One log per medication, patient and scheduled time; used as the upsert conflict target';
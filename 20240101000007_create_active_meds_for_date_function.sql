@@ -0,0 +1,28 @@
+-- Create active_meds_for_date function
+-- Returns the medication schedules that need logs on a given date, so the
+-- scheduler does not have to download and filter every active medication
+-- Requirements: 15.1
+
+-- Composite index matching the function's filter
+CREATE INDEX IF NOT EXISTS idx_medications_active_schedule
+  ON medications(is_active, start_date, end_date, frequency);
+
+CREATE OR REPLACE FUNCTION active_meds_for_date(d DATE)
+RETURNS SETOF medications
+LANGUAGE sql
+STABLE
+AS $$
+  SELECT *
+  FROM medications
+  WHERE is_active
+  AND start_date <= d
+  AND (end_date IS NULL OR end_date >= d)
+  AND (
+    frequency IN ('daily', 'twice_daily', 'three_times_daily')
+    -- Weekly schedules are generated on Mondays
+    OR (frequency = 'weekly' AND EXTRACT(DOW FROM d) = 1)
+  );
+$$;
+
+COMMENT ON FUNCTION active_meds_for_date(DATE) IS
+  'Active medication schedules that should have pending logs generated on the given date (as_needed is never generated)';
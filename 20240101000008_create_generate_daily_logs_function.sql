@@ -0,0 +1,25 @@
+-- Create generate_daily_logs function
+-- Generates pending medication logs for a date entirely inside Postgres:
+-- one row per scheduled time of every medication due that day
+-- Requirements: 15.1
+
+CREATE OR REPLACE FUNCTION generate_daily_logs(d DATE)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  created_count INTEGER;
+BEGIN
+  INSERT INTO medication_logs (medication_id, patient_id, scheduled_time, status)
+  SELECT m.id, m.patient_id, (d + t)::timestamptz, 'pending'
+  FROM active_meds_for_date(d) AS m
+  CROSS JOIN LATERAL UNNEST(m.times) AS t
+  ON CONFLICT (medication_id, patient_id, scheduled_time) DO NOTHING;
+
+  GET DIAGNOSTICS created_count = ROW_COUNT;
+  RETURN created_count;
+END;
+$$;
+
+COMMENT ON FUNCTION generate_daily_logs(DATE) IS
+  'Creates pending medication_logs for every scheduled time on the given date, skipping existing logs; returns the number created';
@@ -10,33 +10,39 @@ Requirements: 15.1, 15.3
 
 import asyncio
 import logging
-from datetime import datetime, time, timedelta
-from typing import Optional, List, Dict, Any
+from datetime import datetime, time, timedelta, timezone
+from typing import Optional, List, Tuple
 
-from supabase import Client
+from supabase import AsyncClient
 
 LOG = logging.getLogger(__name__)
 
+# Bounds (in seconds) for the sleep between missed-medication sweeps
+STATUS_UPDATE_MIN_INTERVAL = 1
+STATUS_UPDATE_MAX_INTERVAL = 15 * 60
+
 
 class MedicationScheduler:
     """
     Handles scheduled tasks for medication management.
     
     This class provides two main scheduled tasks:
-    1. Update overdue medications to 'missed' status (runs every 15 minutes)
+    1. Update overdue medications to 'missed' status (runs when the next
+       pending medication falls due, at least every 15 minutes)
     2. Generate pending logs for upcoming medications (runs daily at midnight)
     """
     
-    def __init__(self, supabase_client: Client):
+    def __init__(self, supabase_client: AsyncClient):
         """
         Initialize the medication scheduler.
         
         Args:
-            supabase_client: Supabase client for database operations
+            supabase_client: Async Supabase client for database operations
         """
         self.supabase = supabase_client
         self._running = False
         self._tasks: List[asyncio.Task] = []
+        self._status_wakeup = asyncio.Event()
     
     async def start(self):
         """Start all scheduled tasks."""
@@ -47,7 +53,7 @@ class MedicationScheduler:
         self._running = True
         LOG.info("Starting medication scheduler...")
         
-        # Start the status update task (every 15 minutes)
+        # Start the status update task (when the next medication is due)
         status_task = asyncio.create_task(self._run_status_update_task())
         self._tasks.append(status_task)
         
@@ -77,21 +83,31 @@ class MedicationScheduler:
     
     async def _run_status_update_task(self):
         """
-        Run the status update task periodically.
+        Run the status update task whenever a pending medication falls due.
         
         This task checks for medications past their scheduled time and updates
-        their status from 'pending' to 'missed'. Runs every 15 minutes.
+        their status from 'pending' to 'missed'. After each sweep it sleeps
+        until the next pending medication is due (at most 15 minutes), and
+        wakes early when new logs are generated.
         
         Requirements: 15.3
         """
-        LOG.info("Status update task started (runs every 15 minutes)")
+        LOG.info("Status update task started (runs when medications fall due)")
         
         while self._running:
             try:
-                await self.update_missed_medications()
+                # Clear before sweeping so a wakeup set while the sweep is in
+                # flight still ends the following wait
+                self._status_wakeup.clear()
+                _, sleep_for = await self._sweep()
+                
+                # Wait until the next pending medication is due
+                LOG.debug(f"Next missed medication check in {sleep_for:.0f} seconds")
                 
-                # Wait 15 minutes before next run
-                await asyncio.sleep(15 * 60)
+                try:
+                    await asyncio.wait_for(self._status_wakeup.wait(), timeout=sleep_for)
+                except asyncio.TimeoutError:
+                    pass
                 
             except asyncio.CancelledError:
                 LOG.info("Status update task cancelled")
@@ -101,6 +117,49 @@ class MedicationScheduler:
                 # Wait before retrying
                 await asyncio.sleep(60)
     
+    async def _sweep(self) -> Tuple[int, float]:
+        """
+        Mark overdue medications as missed and plan the next sweep.
+        
+        The two queries touch disjoint rows (overdue vs. upcoming pending
+        logs), so they are issued concurrently.
+        
+        Returns:
+            Tuple of (number of logs marked missed, seconds until next sweep)
+        """
+        updated_count, sleep_for = await asyncio.gather(
+            self.update_missed_medications(),
+            self._seconds_until_next_due()
+        )
+        return updated_count, sleep_for
+    
+    async def _seconds_until_next_due(self) -> float:
+        """
+        Compute how long to sleep before the next pending medication is due.
+        
+        Returns:
+            Seconds until the earliest upcoming pending log, clamped to
+            [STATUS_UPDATE_MIN_INTERVAL, STATUS_UPDATE_MAX_INTERVAL]
+        """
+        response = await self.supabase.table("medication_logs") \
+            .select("scheduled_time") \
+            .eq("status", "pending") \
+            .gt("scheduled_time", "now") \
+            .order("scheduled_time") \
+            .limit(1) \
+            .execute()
+        
+        if not response.data:
+            return STATUS_UPDATE_MAX_INTERVAL
+        
+        next_due = datetime.fromisoformat(response.data[0]["scheduled_time"])
+        if next_due.tzinfo is None:
+            next_due = next_due.replace(tzinfo=timezone.utc)
+        
+        # Sleep one extra second so the log is strictly overdue when we wake
+        seconds = (next_due - datetime.now(timezone.utc)).total_seconds() + 1
+        return min(max(seconds, STATUS_UPDATE_MIN_INTERVAL), STATUS_UPDATE_MAX_INTERVAL)
+    
     async def _run_log_generation_task(self):
         """
         Run the log generation task daily at midnight.
@@ -149,40 +208,23 @@ class MedicationScheduler:
         Requirements: 15.3
         """
         try:
-            current_time = datetime.now().isoformat()
-            
-            LOG.info(f"Checking for missed medications (current time: {current_time})")
+            LOG.info("Checking for missed medications")
             
-            # Query for pending medications that are past their scheduled time
-            response = self.supabase.table("medication_logs") \
-                .select("id, scheduled_time, patient_id, medication_id") \
+            # Flip every overdue pending log to 'missed' in a single round-trip.
+            # 'now' is resolved by Postgres so the cutoff uses the database clock.
+            response = await self.supabase.table("medication_logs") \
+                .update({"status": "missed"}) \
                 .eq("status", "pending") \
-                .lt("scheduled_time", current_time) \
+                .lt("scheduled_time", "now") \
                 .execute()
             
-            pending_logs = response.data if response.data else []
+            updated_logs = response.data if response.data else []
+            updated_count = len(updated_logs)
             
-            if not pending_logs:
+            if not updated_count:
                 LOG.debug("No missed medications found")
                 return 0
             
-            LOG.info(f"Found {len(pending_logs)} missed medications")
-            
-            # Update each log to 'missed' status
-            updated_count = 0
-            for log in pending_logs:
-                try:
-                    self.supabase.table("medication_logs") \
-                        .update({"status": "missed"}) \
-                        .eq("id", log["id"]) \
-                        .execute()
-                    
-                    updated_count += 1
-                    LOG.debug(f"Updated medication log {log['id']} to 'missed' status")
-                    
-                except Exception as e:
-                    LOG.error(f"Failed to update medication log {log['id']}: {e}")
-            
             LOG.info(f"Successfully updated {updated_count} medication logs to 'missed' status")
             return updated_count
             
@@ -194,8 +236,9 @@ class MedicationScheduler:
         """
         Generate pending medication logs for a specific day.
         
-        This method fetches all active medication schedules and creates
-        pending logs for each scheduled time on the target date.
+        This method calls the generate_daily_logs database function, which
+        creates a pending log for each scheduled time of every medication due
+        on the target date. Logs that already exist are left untouched.
         
         Args:
             target_date: Date to generate logs for (defaults to today)
@@ -213,83 +256,15 @@ class MedicationScheduler:
             
             LOG.info(f"Generating medication logs for {target_date_str}")
             
-            # Query for active medication schedules
-            response = self.supabase.table("medications") \
-                .select("id, patient_id, times, start_date, end_date, frequency") \
-                .eq("is_active", True) \
-                .lte("start_date", target_date_str) \
+            response = await self.supabase \
+                .rpc("generate_daily_logs", {"d": target_date_str}) \
                 .execute()
             
-            medications = response.data if response.data else []
-            
-            # Filter medications that haven't ended yet
-            active_medications = [
-                med for med in medications
-                if med.get("end_date") is None or med["end_date"] >= target_date_str
-            ]
-            
-            if not active_medications:
-                LOG.info("No active medications found")
-                return 0
-            
-            LOG.info(f"Found {len(active_medications)} active medication schedules")
+            created_count = response.data or 0
             
-            created_count = 0
-            
-            for medication in active_medications:
-                medication_id = medication["id"]
-                patient_id = medication["patient_id"]
-                times = medication.get("times", [])
-                frequency = medication.get("frequency", "daily")
-                
-                # Skip if no times specified
-                if not times:
-                    LOG.warning(f"Medication {medication_id} has no scheduled times")
-                    continue
-                
-                # Check if we should generate logs based on frequency
-                if not self._should_generate_for_date(frequency, target_date):
-                    LOG.debug(f"Skipping medication {medication_id} - not scheduled for {target_date_str}")
-                    continue
-                
-                # Create a log for each scheduled time
-                for scheduled_time_str in times:
-                    try:
-                        # Combine date and time
-                        scheduled_datetime = datetime.combine(
-                            target_date.date(),
-                            datetime.strptime(scheduled_time_str, "%H:%M:%S").time()
-                        )
-                        
-                        # Check if log already exists
-                        existing = self.supabase.table("medication_logs") \
-                            .select("id") \
-                            .eq("medication_id", medication_id) \
-                            .eq("patient_id", patient_id) \
-                            .eq("scheduled_time", scheduled_datetime.isoformat()) \
-                            .execute()
-                        
-                        if existing.data:
-                            LOG.debug(f"Log already exists for medication {medication_id} at {scheduled_datetime}")
-                            continue
-                        
-                        # Create new log
-                        log_data = {
-                            "medication_id": medication_id,
-                            "patient_id": patient_id,
-                            "scheduled_time": scheduled_datetime.isoformat(),
-                            "status": "pending"
-                        }
-                        
-                        self.supabase.table("medication_logs") \
-                            .insert(log_data) \
-                            .execute()
-                        
-                        created_count += 1
-                        LOG.debug(f"Created log for medication {medication_id} at {scheduled_datetime}")
-                        
-                    except Exception as e:
-                        LOG.error(f"Failed to create log for medication {medication_id} at {scheduled_time_str}: {e}")
+            # New logs may be due before the status task's next planned sweep
+            if created_count:
+                self._status_wakeup.set()
             
             LOG.info(f"Successfully created {created_count} medication logs for {target_date_str}")
             return created_count
@@ -297,31 +272,3 @@ class MedicationScheduler:
         except Exception as e:
             LOG.error(f"Error generating daily medication logs: {e}", exc_info=True)
             return 0
-    
-    def _should_generate_for_date(self, frequency: str, target_date: datetime) -> bool:
-        """
-        Determine if logs should be generated for a given date based on frequency.
-        
-        Args:
-            frequency: Medication frequency (daily, twice_daily, etc.)
-            target_date: Date to check
-            
-        Returns:
-            True if logs should be generated for this date
-        """
-        # For daily frequencies, always generate
-        if frequency in ['daily', 'twice_daily', 'three_times_daily']:
-            return True
-        
-        # For weekly, only generate on the same day of week as start date
-        # This is a simplified implementation - could be enhanced
-        if frequency == 'weekly':
-            # For now, generate on Mondays (weekday 0)
-            return target_date.weekday() == 0
-        
-        # For as_needed, don't auto-generate
-        if frequency == 'as_needed':
-            return False
-        
-        # Default to generating
-        return True
@@ -2,14 +2,17 @@ import cv2
 import torch
 import numpy as np
 import time
-import json
+import orjson
 import asyncio
 import threading
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from datetime import datetime
-from typing import List
+from typing import Set
 
 # --- YOLOv7 & Fall Detection Logic ---
 # Note: Adjust imports based on your specific repo structure
@@ -19,137 +22,236 @@ from utils.general import non_max_suppression, scale_coords
 from utils.plots import plot_one_box
 from utils.torch_utils import select_device, time_synchronized
 
+# JPEG settings for the MJPEG stream; q=75 is visually fine for a webcam feed
+# and much cheaper to encode than OpenCV's default of 95. The opencv-python
+# wheels bundle libjpeg-turbo, so the encode path is SIMD-accelerated.
+JPEG_ENCODE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 75, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+
 class FallDetector:
-    def __init__(self, weights='yolov7-w6-pose.pt', source='0', device='cpu'):
+    def __init__(self, weights='yolov7-w6-pose.pt', source='0', device='cpu', loop=None):
         self.device = select_device(device)
         self.model = attempt_load(weights, map_location=self.device)
         self.model.eval()
         
+        # FP16 inference on GPU (half precision is only supported on CUDA)
+        self.half = self.device.type != 'cpu'
+        if self.half:
+            self.model.half()
+        
+        # Frames captured while the previous batch was running are inferred
+        # together, up to max_batch at a time (older frames are dropped)
+        self.max_batch = 4
+        self.frames = deque(maxlen=self.max_batch)
+        self.frames_ready = threading.Condition()
+        
+        # Preallocated preprocessing buffers (reused every frame)
+        self._bgr = np.empty((640, 640, 3), dtype=np.uint8)
+        self._rgb = np.empty((640, 640, 3), dtype=np.uint8)
+        self._input = torch.empty((self.max_batch, 3, 640, 640),
+                                  dtype=torch.float16 if self.half else torch.float32,
+                                  device=self.device)
+        
         # Open Webcam
         self.cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
         if not self.cap.isOpened():
             raise IOError(f"Cannot open webcam source: {source}")
             
         # State
-        self.current_frame = None
+        # Published frame as one (frame_id, frame) tuple: a single attribute
+        # assignment swaps it atomically, so readers never take the lock.
+        # Published frames are never written to again (each capture is a new array).
+        self._front = (0, None)
+        self.frame_id = 0
         self.lock = threading.Lock()
+        self.frame_ready = threading.Condition(self.lock)
+        self._jpeg_lock = threading.Lock()
+        self._jpeg_cache = None # encoded JPEG of frame _jpeg_frame_id, shared by all viewers
+        self._jpeg_frame_id = -1
         self.running = True
         self.fall_count = 0
+        self.latest_falls = []
+        
+        # Falls are pushed from the inference thread to the event loop
+        self.loop = loop
+        self.fall_queue = asyncio.Queue(maxsize=256)
         
         # Simple Tracker State
         self.next_track_id = 1
-        self.tracks = {} # {id: {'center': (x,y), 'lost_count': 0}}
+        self._track_ids = np.empty(0, dtype=np.int64)
+        self._track_centers = np.empty((0, 2), dtype=np.float32) # (x, y) per track
+        self._track_lost = np.empty(0, dtype=np.int32) # frames since last match
         
-        # Start capture thread
+        # Start capture and inference threads
         self.thread = threading.Thread(target=self.update, args=())
         self.thread.daemon = True
         self.thread.start()
+        
+        self.infer_thread = threading.Thread(target=self.infer, args=())
+        self.infer_thread.daemon = True
+        self.infer_thread.start()
 
     def update(self):
         while self.running:
+            # cap.read() blocks at the camera's frame rate, so no extra sleep
             ret, frame = self.cap.read()
             if not ret:
+                time.sleep(0.005) # Prevent CPU spin if the driver fails fast
                 continue
             
-            # Inference Logic
-            processed_frame, falls = self.process_frame(frame)
-            
-            with self.lock:
-                self.current_frame = processed_frame
-                self.latest_falls = falls
+            with self.frames_ready:
+                self.frames.append(frame)
+                self.frames_ready.notify()
+
+    def infer(self):
+        while self.running:
+            with self.frames_ready:
+                self.frames_ready.wait_for(lambda: self.frames, timeout=1.0)
+                frames = list(self.frames)
+                self.frames.clear()
+            if not frames:
+                continue
             
-            time.sleep(0.01) # Prevent CPU spin
-
-    def process_frame(self, frame):
-        # Preprocess
-        img = cv2.resize(frame, (640, 640))
-        img = img[:, :, ::-1].transpose(2, 0, 1) # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
-        img = torch.from_numpy(img).to(self.device)
-        img = img.float() / 255.0
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
+            # Inference Logic
+            for processed_frame, falls in self.process_batch(frames):
+                with self.frame_ready:
+                    self.latest_falls = falls
+                    self.frame_id += 1
+                    self._front = (self.frame_id, processed_frame)
+                    self.frame_ready.notify_all()
+                
+                if self.loop is not None:
+                    for fall in falls:
+                        self.loop.call_soon_threadsafe(self._enqueue_fall, fall)
+
+    def _enqueue_fall(self, fall):
+        # Runs on the event loop; drop the alert rather than block if nobody is consuming
+        try:
+            self.fall_queue.put_nowait(fall)
+        except asyncio.QueueFull:
+            pass
+
+    def process_batch(self, frames):
+        # Preprocess into the reusable buffers: resize, BGR to RGB, HWC to Bx3x640x640
+        for i, frame in enumerate(frames):
+            cv2.resize(frame, (640, 640), dst=self._bgr)
+            cv2.cvtColor(self._bgr, cv2.COLOR_BGR2RGB, dst=self._rgb)
+            rgb = torch.from_numpy(self._rgb).to(self.device, non_blocking=True)
+            self._input[i].copy_(rgb.permute(2, 0, 1)).div_(255.0)
+        img = self._input[:len(frames)]
 
         # Detect
-        falls_detected = []
-        with torch.no_grad():
+        with torch.inference_mode():
             pred = self.model(img)[0]
             # Apply NMS
             pred = non_max_suppression(pred, 0.25, 0.45, classes=None, agnostic=False)
+            # Rescale boxes to the original frame; inference tensors can only
+            # be modified in place inside inference mode
+            for det, frame in zip(pred, frames):
+                if len(det):
+                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], frame.shape).round()
 
         # Process Detections
         # Note: This is a simplified fallback if Pose logic isn't fully integrated
         # You should replace this with your specific keypoint analysis from video.py
-        for i, det in enumerate(pred):
+        results = []
+        for det, frame in zip(pred, frames):
+            falls_detected = []
             if len(det):
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], frame.shape).round()
+                # Box geometry and the fall heuristic for all detections at once,
+                # then a single device-to-host transfer
+                boxes = det[:, :4].int()
+                wh = boxes[:, 2:4] - boxes[:, :2]
+                # Heuristic: If Aspect Ratio (Width/Height) > 1.2, possibly fallen
+                # (Replace with Keypoint logic for accuracy). 5*w > 6*h is the
+                # same test in integer math, and already implies h < w
+                fall_mask = 5 * wh[:, 0] > 6 * wh[:, 1]
+                
+                boxes = boxes.cpu().numpy()
+                wh = wh.cpu().numpy()
+                confs = det[:, 4].float().cpu().numpy()
+                classes = det[:, 5].int().cpu().numpy()
+                fall_mask = fall_mask.cpu().numpy()
                 
-                for *xyxy, conf, cls in reversed(det):
-                    # Heuristic: If Aspect Ratio (Width/Height) > 1.2, possibly fallen
-                    x1, y1, x2, y2 = int(xyxy[0]), int(xyxy[1]), int(xyxy[2]), int(xyxy[3])
-                    w = x2 - x1
-                    h = y2 - y1
-                    aspect_ratio = w / h
+                # Annotations are only visible on the MJPEG stream
+                draw = mjpeg_subscribers > 0
+                
+                # Most detections are not falls: draw them without the fall bookkeeping
+                if draw:
+                    for i in np.flatnonzero(~fall_mask)[::-1]:
+                        label = f'{self.model.names[classes[i]]} {confs[i]:.2f}'
+                        plot_one_box(boxes[i], frame, label=label, color=(255, 0, 0), line_thickness=2)
+                
+                for i in np.flatnonzero(fall_mask)[::-1]:
+                    x1, y1 = int(boxes[i, 0]), int(boxes[i, 1])
+                    w, h = int(wh[i, 0]), int(wh[i, 1])
                     
-                    label = f'{self.model.names[int(cls)]} {conf:.2f}'
-                    color = (255, 0, 0)
+                    if draw:
+                        label = f'{self.model.names[classes[i]]} {confs[i]:.2f} FALL DETECTED'
+                        plot_one_box(boxes[i], frame, label=label, color=(0, 0, 255), line_thickness=2)
                     
-                    is_fall = False
-                    # Basic Fall Logic (Replace with Keypoint logic for accuracy)
-                    if aspect_ratio > 1.2 and h < w: 
-                        label += " FALL DETECTED"
-                        color = (0, 0, 255)
-                        is_fall = True
-                        
-                    plot_one_box(xyxy, frame, label=label, color=color, line_thickness=2)
+                    # Assign simple ID based on proximity (Simulated Tracking)
+                    tid = self.get_track_id(x1+w/2, y1+h/2)
                     
-                    if is_fall:
-                        # Assign simple ID based on proximity (Simulated Tracking)
-                        tid = self.get_track_id(x1+w/2, y1+h/2)
-                        
-                        falls_detected.append({
-                            "person_tracking_id": tid,
-                            "bbox": {"x": x1, "y": y1, "width": w, "height": h},
-                            "confidence": float(conf)
-                        })
-
-        return frame, falls_detected
+                    falls_detected.append({
+                        "person_tracking_id": tid,
+                        "bbox": {"x": x1, "y": y1, "width": w, "height": h},
+                        "confidence": float(confs[i])
+                    })
+
+            results.append((frame, falls_detected))
+
+        return results
 
     def get_track_id(self, cx, cy):
         # Very naive tracker for demo purposes
-        min_dist = 100.0
-        found_id = None
+        max_dist_sq = 100.0 ** 2
         
         # Clean old tracks
-        ids_to_remove = []
-        for tid, data in self.tracks.items():
-            data['lost_count'] += 1
-            if data['lost_count'] > 30: # 1 sec @ 30fps
-                ids_to_remove.append(tid)
-            else:
-                dist = np.sqrt((cx - data['center'][0])**2 + (cy - data['center'][1])**2)
-                if dist < min_dist:
-                    min_dist = dist
-                    found_id = tid
+        self._track_lost += 1
+        keep = self._track_lost <= 30 # 1 sec @ 30fps
+        if not keep.all():
+            self._track_ids = self._track_ids[keep]
+            self._track_centers = self._track_centers[keep]
+            self._track_lost = self._track_lost[keep]
         
-        for tid in ids_to_remove:
-            del self.tracks[tid]
-            
-        if found_id is not None:
-            self.tracks[found_id]['center'] = (cx, cy)
-            self.tracks[found_id]['lost_count'] = 0
-            return found_id
-        else:
-            new_id = self.next_track_id
-            self.next_track_id += 1
-            self.tracks[new_id] = {'center': (cx, cy), 'lost_count': 0}
-            return new_id
+        # Nearest remaining track by squared distance
+        if len(self._track_ids):
+            diff = self._track_centers - np.array((cx, cy), dtype=np.float32)
+            dist_sq = np.einsum('ij,ij->i', diff, diff)
+            i = int(dist_sq.argmin())
+            if dist_sq[i] < max_dist_sq:
+                self._track_centers[i] = (cx, cy)
+                self._track_lost[i] = 0
+                return int(self._track_ids[i])
+        
+        new_id = self.next_track_id
+        self.next_track_id += 1
+        self._track_ids = np.append(self._track_ids, new_id)
+        self._track_centers = np.vstack((self._track_centers, np.array([(cx, cy)], dtype=np.float32)))
+        self._track_lost = np.append(self._track_lost, np.int32(0))
+        return new_id
+
+    def wait_for_frame(self, last_frame_id, timeout=1.0):
+        # Block until a frame newer than last_frame_id is available (or timeout)
+        with self.frame_ready:
+            self.frame_ready.wait_for(lambda: self.frame_id != last_frame_id, timeout)
+            return self.frame_id
 
     def get_frame(self):
-        with self.lock:
-            if self.current_frame is None:
+        # Lock-free; the returned frame is shared and must not be modified
+        return self._front[1]
+
+    def get_jpeg(self):
+        # Encode lazily, at most once per frame no matter how many viewers
+        with self._jpeg_lock:
+            frame_id, frame = self._front
+            if frame is None:
                 return None
-            return self.current_frame.copy()
+            if frame_id != self._jpeg_frame_id:
+                _, buffer = cv2.imencode('.jpg', frame, JPEG_ENCODE_PARAMS)
+                self._jpeg_cache = buffer.tobytes()
+                self._jpeg_frame_id = frame_id
+            return self._jpeg_cache
 
     def get_alerts(self):
         with self.lock:
@@ -171,34 +273,43 @@ app.add_middleware(
 # Initialize Detector (Global Singleton)
 detector = None
 
+# Number of connected MJPEG viewers (frames are only annotated and encoded while > 0)
+mjpeg_subscribers = 0
+
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     global detector
     # Load default weights, ensure 'yolov7-w6-pose.pt' exists or change path
     try:
-        detector = FallDetector(weights='yolov7-w6-pose.pt', source='0')
-        print("Model loaded and camera started.")
+        device = '0' if torch.cuda.is_available() else 'cpu'
+        detector = FallDetector(weights='yolov7-w6-pose.pt', source='0', device=device,
+                                loop=asyncio.get_running_loop())
+        print(f"Model loaded on {detector.device} and camera started.")
     except Exception as e:
         print(f"Error starting detector: {e}")
 
 # Connection Manager for WebSockets
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
+        # Send to all clients concurrently; drop any socket whose send failed
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True
+        )
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.active_connections.discard(connection)
 
 manager = ConnectionManager()
 
@@ -206,34 +317,35 @@ manager = ConnectionManager()
 async def alert_broadcaster():
     last_alert_time = {} # Throttle alerts per tracking_id
     
+    if detector is None:
+        return
+    
     while True:
-        await asyncio.sleep(0.1)
-        if detector and detector.latest_falls:
-            current_time = time.time()
+        fall = await detector.fall_queue.get()
+        current_time = time.time()
+        tid = fall['person_tracking_id']
+        
+        # Throttle: 1 alert every 3 seconds per person
+        if tid not in last_alert_time or (current_time - last_alert_time[tid] > 3.0):
+            last_alert_time[tid] = current_time
+            detector.fall_count += 1
             
-            for fall in detector.latest_falls:
-                tid = fall['person_tracking_id']
-                
-                # Throttle: 1 alert every 3 seconds per person
-                if tid not in last_alert_time or (current_time - last_alert_time[tid] > 3.0):
-                    last_alert_time[tid] = current_time
-                    detector.fall_count += 1
-                    
-                    # Construct message matching React's FallAlertMessage
-                    message = {
-                        "type": "fall_detected",
-                        "data": {
-                            "patient_id": "room-1", # You can make this dynamic
-                            "person_tracking_id": tid,
-                            "fall_count": detector.fall_count,
-                            "timestamp": datetime.utcnow().isoformat(),
-                            "metadata": {
-                                "bounding_box": fall['bbox'],
-                                "confidence": fall['confidence']
-                            }
-                        }
+            # Construct message matching React's FallAlertMessage
+            message = {
+                "type": "fall_detected",
+                "data": {
+                    "patient_id": "room-1", # You can make this dynamic
+                    "person_tracking_id": tid,
+                    "fall_count": detector.fall_count,
+                    "timestamp": datetime.utcnow(), # orjson emits ISO 8601 natively
+                    "metadata": {
+                        "bounding_box": fall['bbox'],
+                        "confidence": fall['confidence']
                     }
-                    await manager.broadcast(json.dumps(message))
+                }
+            }
+            # Sent as a text frame: the React client JSON.parses event.data
+            await manager.broadcast(orjson.dumps(message).decode())
 
 # Start broadcaster on startup
 @app.on_event("startup")
@@ -242,18 +354,33 @@ async def start_background_tasks():
 
 # --- API Endpoints ---
 
+# JPEG encoding runs here so it never blocks the event loop
+encode_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
 @app.get("/api/video/stream")
 def video_feed(patient_id: str = "default"):
     """MJPEG Video Stream for React Frontend"""
-    def iterfile():
-        while True:
-            if detector:
-                frame = detector.get_frame()
-                if frame is not None:
-                    _, buffer = cv2.imencode('.jpg', frame)
+    async def iterfile():
+        global mjpeg_subscribers
+        loop = asyncio.get_running_loop()
+        last_frame_id = 0
+        mjpeg_subscribers += 1
+        try:
+            while True:
+                if not detector:
+                    await asyncio.sleep(1.0)
+                    continue
+                # Wait off the event loop until the detector publishes a new frame
+                frame_id = await loop.run_in_executor(None, detector.wait_for_frame, last_frame_id, 1.0)
+                if frame_id == last_frame_id:
+                    continue
+                last_frame_id = frame_id
+                jpeg = await loop.run_in_executor(encode_pool, detector.get_jpeg)
+                if jpeg is not None:
                     yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
-            time.sleep(0.04) # ~25 FPS
+                           b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n')
+        finally:
+            mjpeg_subscribers -= 1
 
     return StreamingResponse(iterfile(), media_type="multipart/x-mixed-replace; boundary=frame")
 